@@ -0,0 +1,68 @@
+import time
+
+from wiki_mcp_server import canonical_cache, canonicalize_queries, canonicalize_query
+
+# Spelling variants of the same few topics, as agents tend to send them
+QUERIES = [
+    "King penguins", "king penguin", "the King Penguin", "King Penguin species",
+    "species of king penguins", "Emperor penguin", "emperor penguins",
+    "the emperor penguin", "Penguins of Antarctica", "antarctic penguins",
+    "penguin in Antarctica", "History of the Roman Empire", "roman empire history",
+    "the history of Rome's empire", "Roman Empire"
+]
+
+def hit_ratio(keys):
+    """Hit ratio of an unbounded cache keyed by `keys` in request order"""
+    seen = set()
+    hits = 0
+    for key in keys:
+        if key in seen:
+            hits += 1
+        seen.add(key)
+    return hits / len(keys)
+
+def test_cache_hit_ratio():
+    """Compare cache hit ratio with raw and canonical keys"""
+    print("Testing cache hit ratio...")
+    raw = hit_ratio(QUERIES)
+    canonical = hit_ratio(canonicalize_queries(QUERIES))
+    print(f"Raw keys: {raw:.2f}")
+    print(f"Canonical keys: {canonical:.2f}")
+    # The variants from the original request must share one cache key
+    assert len(set(canonicalize_queries(["King penguins", "king penguin", "the King Penguin"]))) == 1
+    assert canonical > raw
+
+def test_canonical_cpu_cost():
+    """Measure per-query CPU cost of canonicalization"""
+    print("\nTesting canonicalization CPU cost...")
+    # Before: the raw query string was the key
+    start = time.process_time()
+    for query in QUERIES:
+        hash(query)
+    raw = (time.process_time() - start) / len(QUERIES)
+
+    canonical_cache.clear()
+    start = time.process_time()
+    for query in QUERIES:
+        canonicalize_query(query)
+    single = (time.process_time() - start) / len(QUERIES)
+
+    canonical_cache.clear()
+    start = time.process_time()
+    canonicalize_queries(QUERIES)
+    batched = (time.process_time() - start) / len(QUERIES)
+
+    start = time.process_time()
+    canonicalize_queries(QUERIES)
+    memoized = (time.process_time() - start) / len(QUERIES)
+
+    print(f"Raw key (before): {raw * 1000:.3f} ms/query")
+    print(f"Single: {single * 1000:.3f} ms/query")
+    print(f"Batched (nlp.pipe): {batched * 1000:.3f} ms/query")
+    print(f"Memoized: {memoized * 1000:.3f} ms/query")
+    assert memoized < single
+    assert memoized < batched
+
+if __name__ == "__main__":
+    test_cache_hit_ratio()
+    test_canonical_cpu_cost()
@@ -0,0 +1,54 @@
+import asyncio
+
+import wiki_mcp_server
+from wiki_mcp_server import (
+    PREFETCH_REFRESH_WINDOW, HeavyHitters, TTLCache, UpstreamBudget, WikipediaMCPServer, prefetch_popular
+)
+
+def run_prefetch(hot_queries, hot_titles, budget):
+    """Run one prefetch pass over fresh state; returns the upstream fetches made"""
+    fetched = []
+    # Entries that expire within the refresh window, as left behind by live searches
+    wiki_mcp_server.search_cache = TTLCache(ttl=PREFETCH_REFRESH_WINDOW)
+    wiki_mcp_server.article_cache = TTLCache()
+    wiki_mcp_server.query_popularity = HeavyHitters()
+    wiki_mcp_server.title_popularity = HeavyHitters()
+    wiki_mcp_server.prefetch_budget = UpstreamBudget(limit=budget)
+
+    for query, limit in hot_queries:
+        wiki_mcp_server.search_cache.set(query, {"query": query, "limit": limit, "articles": []})
+        wiki_mcp_server.query_popularity.add(query)
+    for title in hot_titles:
+        wiki_mcp_server.title_popularity.add(title)
+
+    originals = (WikipediaMCPServer.fetch_search_articles, WikipediaMCPServer.fetch_article)
+    WikipediaMCPServer.fetch_search_articles = lambda self, query, limit=5, **kwargs: fetched.append(("search", query)) or []
+    WikipediaMCPServer.fetch_article = lambda self, title: fetched.append(("article", title)) or {"title": title}
+    try:
+        asyncio.run(prefetch_popular())
+    finally:
+        WikipediaMCPServer.fetch_search_articles, WikipediaMCPServer.fetch_article = originals
+    return fetched
+
+def test_expensive_query_does_not_block_prefetch():
+    """An unaffordable query is skipped; cheaper queries and titles still prefetch"""
+    print("Testing prefetch budget...")
+    fetched = run_prefetch([("big", 50), ("small", 5)], ["Title A", "Title B"], budget=30)
+    print(f"Fetched: {fetched}")
+    assert ("search", "big") not in fetched
+    assert ("search", "small") in fetched
+    assert ("article", "Title A") in fetched
+    assert ("article", "Title B") in fetched
+
+def test_titles_keep_a_budget_reserve():
+    """Many hot queries cannot use up the budget needed for titles"""
+    print("\nTesting title reserve...")
+    queries = [(f"query {i}", 5) for i in range(10)]
+    fetched = run_prefetch(queries, ["Title A", "Title B"], budget=30)
+    print(f"Fetched: {fetched}")
+    assert ("article", "Title A") in fetched
+    assert ("article", "Title B") in fetched
+
+if __name__ == "__main__":
+    test_expensive_query_does_not_block_prefetch()
+    test_titles_keep_a_budget_reserve()
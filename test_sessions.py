@@ -0,0 +1,53 @@
+import asyncio
+import tracemalloc
+
+from wiki_mcp_server import session_events, sessions
+
+# Number of idle sessions to hold open during the soak
+SESSION_COUNT = 5000
+# Ceiling on memory per idle session (session, queue, parked generator and its task)
+MAX_BYTES_PER_SESSION = 16 * 1024
+
+async def soak_idle_sessions(count):
+    """Open idle sessions and measure the memory each one holds"""
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    streams = []
+    for _ in range(count):
+        stream = session_events()
+        await stream.__anext__()  # opens the session and yields the init event
+        streams.append(stream)
+
+    # Park every stream on its queue, as an idle connection would be
+    pending = [asyncio.ensure_future(stream.__anext__()) for stream in streams]
+    await asyncio.sleep(0)
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for stream in streams:
+        await stream.aclose()
+
+    return {
+        "sessions": count,
+        "bytes_per_session": (current - baseline) / count,
+        "peak_bytes": peak - baseline,
+        "leaked_sessions": len(sessions)
+    }
+
+def test_idle_session_memory():
+    """Soak test: memory per idle /sse session"""
+    print("Testing idle session memory...")
+    result = asyncio.run(soak_idle_sessions(SESSION_COUNT))
+    print(f"Sessions: {result['sessions']}")
+    print(f"Bytes per idle session: {result['bytes_per_session']:.0f}")
+    print(f"Peak bytes: {result['peak_bytes']}")
+    assert result["leaked_sessions"] == 0
+    assert result["bytes_per_session"] < MAX_BYTES_PER_SESSION
+
+if __name__ == "__main__":
+    test_idle_session_memory()
@@ -12,13 +12,22 @@ import time
 from datetime import datetime
 import uuid
 import os
-from fastapi import FastAPI, HTTPException, Request
+import base64
+import gc
+import hmac
+import tracemalloc
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from dotenv import load_dotenv
+from bs4 import BeautifulSoup
 import asyncio
+import threading
+from collections import OrderedDict, deque
 from starlette.background import BackgroundTask
 
 # Load environment variables
@@ -40,6 +49,26 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", "300"))
 KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", "60"))
 MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "100"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+MAX_CACHE_SIZE = int(os.getenv("MAX_CACHE_SIZE", "1000"))
+POPULARITY_CAPACITY = int(os.getenv("POPULARITY_CAPACITY", "256"))
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", "10"))
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", "300"))
+PREFETCH_REFRESH_WINDOW = int(os.getenv("PREFETCH_REFRESH_WINDOW", "600"))
+PREFETCH_BUDGET = int(os.getenv("PREFETCH_BUDGET", "30"))
+SESSION_QUEUE_SIZE = int(os.getenv("SESSION_QUEUE_SIZE", "32"))
+SESSION_MAX_INFLIGHT = int(os.getenv("SESSION_MAX_INFLIGHT", "8"))
+SEARCH_STREAM_TTL = int(os.getenv("SEARCH_STREAM_TTL", "300"))
+MAX_SEARCH_STREAMS = int(os.getenv("MAX_SEARCH_STREAMS", "500"))
+MAX_STREAM_EVENTS = int(os.getenv("MAX_STREAM_EVENTS", "200"))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "50"))
+MAX_SEARCH_LIMIT = int(os.getenv("MAX_SEARCH_LIMIT", "100"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+MAX_PROFILE_SECONDS = int(os.getenv("MAX_PROFILE_SECONDS", "30"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
 
 app = FastAPI(
     title="Wikipedia MCP Server",
@@ -86,6 +115,7 @@ class SearchRequest(BaseModel):
     topic: str
     limit: int = 5
     model: str = "gpt-3.5-turbo"
+    cursor: Optional[str] = None
 
 class EvaluateRequest(BaseModel):
     article: Article
@@ -107,6 +137,7 @@ def load_stats():
         "endpoints": {},
         "models": {},
         "errors": 0,
+        "tokens": {},
         "last_update": time.time()
     }
 
@@ -115,22 +146,354 @@ def save_stats(stats):
     with open(STATS_FILE, "w") as f:
         json.dump(stats, f)
 
+# Stats are read-modify-written from worker threads as well as the event loop
+stats_lock = threading.Lock()
+
 def update_stats(endpoint, model, error=False):
-    stats = load_stats()
-    stats["total_requests"] += 1
+    with stats_lock:
+        stats = load_stats()
+        stats["total_requests"] += 1
+        
+        if endpoint not in stats["endpoints"]:
+            stats["endpoints"][endpoint] = 0
+        stats["endpoints"][endpoint] += 1
+        
+        if model not in stats["models"]:
+            stats["models"][model] = 0
+        stats["models"][model] += 1
+        
+        if error:
+            stats["errors"] += 1
+        
+        merge_tokens(stats, take_pending_tokens())
+        save_stats(stats)
+
+# Token usage is accumulated in memory and flushed with the next update_stats write
+pending_tokens = {}
+tokens_lock = threading.Lock()
+
+def record_tokens(endpoint, model, usage):
+    """
+    Add an OpenRouter `usage` block to the per-endpoint, per-model token counts
+    """
+    if not usage:
+        return
+    with tokens_lock:
+        counts = pending_tokens.setdefault(endpoint, {}).setdefault(
+            model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        )
+        counts["calls"] += 1
+        counts["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        counts["completion_tokens"] += usage.get("completion_tokens", 0)
+
+def take_pending_tokens(clear=True):
+    global pending_tokens
+    with tokens_lock:
+        taken = pending_tokens
+        if clear:
+            pending_tokens = {}
+        else:
+            taken = {
+                endpoint: {model: dict(counts) for model, counts in models.items()}
+                for endpoint, models in taken.items()
+            }
+    return taken
+
+def merge_tokens(stats, tokens):
+    for endpoint, models in tokens.items():
+        for model, counts in models.items():
+            totals = stats.setdefault("tokens", {}).setdefault(endpoint, {}).setdefault(
+                model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+            )
+            for key, value in counts.items():
+                totals[key] += value
+
+# Prompt building
+CHARS_PER_TOKEN = 4
+DEFAULT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1024"))
+# Cap for short inputs such as titles and search phrases
+FIELD_TOKEN_BUDGET = int(os.getenv("PROMPT_FIELD_TOKENS", "64"))
+# Prompt tokens allowed per model; leaves most of the context for the completion
+MODEL_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 1024,
+    "gpt-4": 2048,
+    "claude-2": 2048,
+    "mistral-7b": 1024,
+    "mistralai/mistral-7b-instruct": 512
+}
+RELEVANCE_MODEL = "mistralai/mistral-7b-instruct"
+
+# Shared by every relevance call; sent as a fixed system message so the prefix can be cached
+RELEVANCE_RUBRIC = """You are an expert evaluator tasked with precisely assessing the relevance of a Wikipedia article to a given search phrase.
+
+### Strict Evaluation Criteria:
+- SCORE 0.9-1.0: Article is exactly about the search phrase, highly specific, and directly matches.
+- SCORE 0.7-0.8: Article strongly related but broader or less specific.
+- SCORE 0.4-0.6: Moderately related, mentions key concepts briefly.
+- SCORE 0.1-0.3: Loosely related, minimal relevance.
+- SCORE 0.0: Not relevant or off-topic.
+
+### Your Task:
+Provide the exact numeric SCORE according to the criteria above, followed by a concise REASON (one sentence).
+
+### Output (strictly follow this format):
+SCORE: [0.0-1.0]
+REASON: [one concise sentence]"""
+
+def estimate_tokens(text):
+    """
+    Rough token count (about four characters per token)
+    """
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+RELEVANCE_RUBRIC_TOKENS = estimate_tokens(RELEVANCE_RUBRIC)
+
+def strip_markup(text):
+    """
+    Remove MediaWiki search highlighting and other HTML from a snippet
+    """
+    if not text:
+        return ""
+    return " ".join(BeautifulSoup(text, "html.parser").get_text().split())
+
+def truncate_to_tokens(text, tokens):
+    max_chars = max(tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    # Leave room for the ellipsis
+    cut = text[:max(max_chars - 3, 0)]
+    if " " in cut:
+        cut = cut[:cut.rfind(" ")]
+    return cut + "..."
+
+def build_messages(model, template, text, fields=None, system=None, system_tokens=0):
+    """
+    Chat messages for `template` filled with `fields` and followed by `text`
     
-    if endpoint not in stats["endpoints"]:
-        stats["endpoints"][endpoint] = 0
-    stats["endpoints"][endpoint] += 1
+    Markup is stripped from every input. Each field is capped so the fields
+    take at most half of the budget left after the system message, and `text`
+    is truncated to what remains, so the whole prompt fits the model's budget.
+    """
+    budget = MODEL_TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+    fields = fields or {}
+    available = max(budget - system_tokens - estimate_tokens(template), 0)
+    if fields:
+        field_tokens = min(FIELD_TOKEN_BUDGET, available // (2 * len(fields)))
+        fields = {
+            name: truncate_to_tokens(strip_markup(value), field_tokens)
+            for name, value in fields.items()
+        }
+    prompt = template.format(**fields) + "\n\n"
+    remaining = budget - system_tokens - estimate_tokens(prompt)
+    text = truncate_to_tokens(strip_markup(text), remaining)
     
-    if model not in stats["models"]:
-        stats["models"][model] = 0
-    stats["models"][model] += 1
+    messages = []
+    if system:
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": prompt + text})
+    return messages
+
+# Caching and popularity tracking
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a fixed TTL
+    """
+    def __init__(self, maxsize=MAX_CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def clear(self):
+        """
+        Drop every entry and reset the hit/miss counters
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def peek(self, key):
+        """
+        Value for the key even if it has expired, without counting a lookup
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[0] if entry is not None else None
+
+    def needs_refresh(self, key, window):
+        """
+        True if the key is missing or expires within `window` seconds
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is None or entry[1] - time.time() <= window
+
+    def __len__(self):
+        return len(self._data)
+
+class HeavyHitters:
+    """
+    Space-Saving sketch: tracks the most frequent keys in bounded memory
+    """
+    def __init__(self, capacity=POPULARITY_CAPACITY):
+        self.capacity = capacity
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        if not key:
+            return
+        with self._lock:
+            if key in self._counts:
+                self._counts[key] += 1
+            elif len(self._counts) < self.capacity:
+                self._counts[key] = 1
+            else:
+                # Evict the smallest counter and inherit its count as error bound
+                victim = min(self._counts, key=self._counts.get)
+                self._counts[key] = self._counts.pop(victim) + 1
+
+    def top(self, n):
+        with self._lock:
+            items = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return items[:n]
+
+    def decay(self):
+        """
+        Halve every count so the sketch follows what is popular now
+        """
+        with self._lock:
+            self._counts = {key: count // 2 for key, count in self._counts.items() if count > 1}
+
+class UpstreamBudget:
+    """
+    Caps the number of upstream (Wikipedia/OpenRouter) calls per interval
+    """
+    def __init__(self, limit=PREFETCH_BUDGET, interval=PREFETCH_INTERVAL):
+        self.limit = limit
+        self.interval = interval
+        self._used = 0
+        self._window_start = time.time()
+        self._lock = threading.Lock()
+
+    def try_spend(self, cost, reserve=0):
+        """
+        Spend `cost` calls unless that would leave fewer than `reserve` in this interval
+        """
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.interval:
+                self._window_start = now
+                self._used = 0
+            if self._used + cost > self.limit - reserve:
+                return False
+            self._used += cost
+            return True
+
+search_cache = TTLCache()
+article_cache = TTLCache()
+query_popularity = HeavyHitters()
+title_popularity = HeavyHitters()
+prefetch_budget = UpstreamBudget()
+
+# Query canonicalization
+# Lemmas only need the tagger and attribute ruler, so skip the expensive components
+CANONICAL_DISABLE = ["parser", "ner"]
+canonical_cache = TTLCache()
+
+def canonical_terms(doc):
+    terms = {
+        lemmatizer.lemmatize(token.lemma_.lower())
+        for token in doc
+        if not (token.is_stop or token.is_punct or token.is_space)
+    }
+    return " ".join(sorted(terms))
+
+def canonicalize_queries(queries):
+    """
+    Canonicalize queries in one spaCy batch, reusing memoized results
+    """
+    results = {}
+    pending = []
+    for query in queries:
+        cached = canonical_cache.get(query)
+        if cached is None:
+            pending.append(query)
+        else:
+            results[query] = cached
     
-    if error:
-        stats["errors"] += 1
+    pending = list(dict.fromkeys(pending))
+    docs = nlp.pipe([query.lower() for query in pending], disable=CANONICAL_DISABLE)
+    for query, doc in zip(pending, docs):
+        # Fall back to the normalized raw query if every term was a stopword
+        canonical = canonical_terms(doc) or " ".join(query.lower().split())
+        canonical_cache.set(query, canonical)
+        results[query] = canonical
     
-    save_stats(stats)
+    return [results[query] for query in queries]
+
+def canonicalize_query(query):
+    """
+    Lowercase, lemmatize, drop stopwords and sort the terms of a query
+    """
+    return canonicalize_queries([query])[0]
+
+# Search pagination
+def encode_cursor(query, offset):
+    """
+    Opaque cursor for the search results of `query` starting at `offset`
+    """
+    payload = json.dumps({"query": query, "offset": offset})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return payload["query"], int(payload["offset"])
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+def check_limit(limit):
+    """
+    Every result costs a relevance call, so bound how many one request can ask for
+    """
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+
+def next_cursor(query, offset, limit, count):
+    """
+    Cursor for the page after one that returned `count` of `limit` results
+    """
+    if count < limit:
+        return None
+    return encode_cursor(query, offset + count)
 
 class WikipediaMCPServer:
     def __init__(self):
@@ -148,7 +511,34 @@ class WikipediaMCPServer:
                         "limit": {
                             "type": "integer",
                             "description": "Maximum number of results",
-                            "default": 5
+                            "default": 5,
+                            "minimum": 1,
+                            "maximum": MAX_SEARCH_LIMIT
+                        }
+                    },
+                    "required": ["query"]
+                }
+            },
+            "search_articles_page": {
+                "name": "search_articles_page",
+                "description": "Search for Wikipedia articles one page at a time",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": "Search phrase"
+                        },
+                        "limit": {
+                            "type": "integer",
+                            "description": "Maximum number of results in the page",
+                            "default": 5,
+                            "minimum": 1,
+                            "maximum": MAX_SEARCH_LIMIT
+                        },
+                        "cursor": {
+                            "type": "string",
+                            "description": "next_cursor from the previous page"
                         }
                     },
                     "required": ["query"]
@@ -239,6 +629,8 @@ class WikipediaMCPServer:
         """
         if name == "search_articles":
             return self.search_articles(**parameters)
+        elif name == "search_articles_page":
+            return self.search_articles_page(**parameters)
         elif name == "get_article":
             return self.get_article(**parameters)
         elif name == "evaluate_relevance":
@@ -263,42 +655,121 @@ class WikipediaMCPServer:
         """
         Search Wikipedia articles
         """
+        check_limit(limit)
+        if include_images:
+            query_popularity.add(canonicalize_query(query))
+            return self.fetch_search_articles(query, limit, include_images, endpoint="mcp")
+        return list(self.iter_search_articles(query, limit, endpoint="mcp"))
+
+    def search_articles_page(self, query, limit=5, cursor=None):
+        """
+        Search Wikipedia articles, returning one page and a cursor for the next
+        """
+        check_limit(limit)
+        offset = 0
+        if cursor:
+            query, offset = decode_cursor(cursor)
+        articles = list(self.iter_search_articles(query, limit, offset, endpoint="mcp"))
+        return {
+            "articles": articles,
+            "next_cursor": next_cursor(query, offset, limit, len(articles))
+        }
+
+    def iter_search_articles(self, query, limit=5, offset=0, endpoint="search"):
+        """
+        Yield scored search results one by one, serving from the cache when possible
+        
+        The canonical form of the query is only the cache and popularity key;
+        Wikipedia and the relevance model get the phrase as the client wrote it.
+        """
+        if offset:
+            yield from self.iter_fetch_search_articles(query, limit, offset=offset, endpoint=endpoint)
+            return
+        
+        key = canonicalize_query(query)
+        query_popularity.add(key)
+        cached = search_cache.get(key)
+        if cached is not None and cached["limit"] >= limit:
+            yield from cached["articles"][:limit]
+            return
+        
+        articles = []
+        for article in self.iter_fetch_search_articles(query, limit, endpoint=endpoint):
+            articles.append(article)
+            yield article
+        search_cache.set(key, {"query": query, "limit": limit, "articles": articles})
+
+    def fetch_search_articles(self, query, limit=5, include_images=False, endpoint="search"):
+        """
+        Search Wikipedia articles and score them, bypassing the cache
+        """
+        return list(self.iter_fetch_search_articles(query, limit, include_images, endpoint=endpoint))
+
+    def iter_fetch_search_articles(self, query, limit=5, include_images=False, offset=0, endpoint="search"):
+        """
+        Yield scored search results as each one is evaluated, bypassing the cache
+        """
+        pages = self.iter_search_pages(query, limit, offset)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(next, pages, None)
+            while True:
+                results = future.result()
+                if results is None:
+                    break
+                # Fetch the next page while this one is being scored
+                future = executor.submit(next, pages, None)
+                
+                for article in results:
+                    article_data = {
+                        "title": article.get("title", ""),
+                        "url": f"https://en.wikipedia.org/wiki/{article.get('title', '').replace(' ', '_')}",
+                        "snippet": article.get("snippet", ""),
+                        "relevance_score": self.evaluate_relevance_llm(article, query, endpoint)
+                    }
+                    
+                    # Get images if requested
+                    if include_images:
+                        article_data["images"] = self.get_article_images(article.get("title", ""))
+                    
+                    yield article_data
+
+    def iter_search_pages(self, query, limit=5, offset=0):
+        """
+        Yield raw search result pages, following the API's continuation
+        """
         url = "https://en.wikipedia.org/w/api.php"
         
-        # First, search for articles
         params = {
             "action": "query",
             "list": "search",
             "srsearch": query,
-            "srlimit": limit,
+            "sroffset": offset,
             "format": "json",
             "srprop": "snippet|titlesnippet|categorysnippet",
-            "srwhat": "nearmatch",
+            # Full-text search; nearmatch returns at most one title match and cannot page
+            "srwhat": "text",
             "srnamespace": 0,
             "srredirects": "exclude"
         }
         
-        time.sleep(REQUEST_DELAY)
-        response = requests.get(url, params=params)
-        data = response.json()
-        results = data.get("query", {}).get("search", [])
-        
-        articles = []
-        for article in results:
-            article_data = {
-                "title": article.get("title", ""),
-                "url": f"https://en.wikipedia.org/wiki/{article.get('title', '').replace(' ', '_')}",
-                "snippet": article.get("snippet", ""),
-                "relevance_score": self.evaluate_relevance_llm(article, query)
-            }
+        remaining = limit
+        while remaining > 0:
+            params["srlimit"] = min(remaining, SEARCH_PAGE_SIZE)
             
-            # Get images if requested
-            if include_images:
-                article_data["images"] = self.get_article_images(article.get("title", ""))
+            time.sleep(REQUEST_DELAY)
+            response = requests.get(url, params=params)
+            data = response.json()
+            results = data.get("query", {}).get("search", [])[:remaining]
+            if not results:
+                return
             
-            articles.append(article_data)
-        
-        return articles
+            yield results
+            remaining -= len(results)
+            
+            continuation = data.get("continue")
+            if not continuation:
+                return
+            params.update(continuation)
 
     def get_article_images(self, title):
         """
@@ -354,6 +825,20 @@ class WikipediaMCPServer:
         """
         Get Wikipedia article by title
         """
+        title_popularity.add(title)
+        cached = article_cache.get(title)
+        if cached is not None:
+            return cached
+        
+        article = self.fetch_article(title)
+        if "error" not in article:
+            article_cache.set(title, article)
+        return article
+
+    def fetch_article(self, title):
+        """
+        Get Wikipedia article by title, bypassing the cache
+        """
         url = "https://en.wikipedia.org/w/api.php"
         
         params = {
@@ -388,41 +873,29 @@ class WikipediaMCPServer:
         return {
             "score": self.evaluate_relevance_llm(
                 {"title": article_title, "snippet": article_snippet},
-                search_phrase
+                search_phrase,
+                endpoint="mcp"
             )
         }
 
-    def evaluate_relevance_llm(self, article, search_phrase):
+    def evaluate_relevance_llm(self, article, search_phrase, endpoint="search"):
         """
         Evaluate article relevance using OpenRouter
         """
-        article_title = article.get("title", "")
-        article_snippet = article.get("snippet", "")
-        
-        prompt = f"""
-        You are an expert evaluator tasked with precisely assessing the relevance of a Wikipedia article to a given search phrase.
-
-        ### Search Phrase:
-        {search_phrase}
-
-        ### Wikipedia Article:
-        - **Title:** {article_title}
-        - **Snippet:** {article_snippet}
-
-        ### Strict Evaluation Criteria:
-        - SCORE 0.9-1.0: Article is exactly about the search phrase, highly specific, and directly matches.
-        - SCORE 0.7-0.8: Article strongly related but broader or less specific.
-        - SCORE 0.4-0.6: Moderately related, mentions key concepts briefly.
-        - SCORE 0.1-0.3: Loosely related, minimal relevance.
-        - SCORE 0.0: Not relevant or off-topic.
+        template = """### Search Phrase:
+{search_phrase}
 
-        ### Your Task:
-        Provide the exact numeric SCORE according to the criteria above, followed by a concise REASON (one sentence).
-
-        ### Output (strictly follow this format):
-        SCORE: [0.0-1.0]
-        REASON: [one concise sentence]
-        """
+### Wikipedia Article:
+- **Title:** {title}
+- **Snippet:**"""
+        messages = build_messages(
+            RELEVANCE_MODEL,
+            template,
+            article.get("snippet", ""),
+            fields={"search_phrase": search_phrase, "title": article.get("title", "")},
+            system=RELEVANCE_RUBRIC,
+            system_tokens=RELEVANCE_RUBRIC_TOKENS
+        )
         
         try:
             response = requests.post(
@@ -432,12 +905,14 @@ class WikipediaMCPServer:
                     "Content-Type": "application/json"
                 },
                 json={
-                    "model": "mistralai/mistral-7b-instruct",
-                    "messages": [{"role": "user", "content": prompt}]
+                    "model": RELEVANCE_MODEL,
+                    "messages": messages
                 }
             )
             
-            content = response.json()["choices"][0]["message"]["content"]
+            result = response.json()
+            record_tokens(endpoint, RELEVANCE_MODEL, result.get("usage"))
+            content = result["choices"][0]["message"]["content"]
             score_match = re.search(r"SCORE:\s*([0-9.]+)", content)
             if score_match:
                 return float(score_match.group(1))
@@ -447,29 +922,137 @@ class WikipediaMCPServer:
             print(f"Error evaluating relevance: {str(e)}")
             return 0.0
 
+# Resumable search streams
+class SearchStream:
+    """
+    Numbered events of one search, buffered so a dropped client can resume
+    
+    Only the last MAX_STREAM_EVENTS events are kept; `base` is the id of the
+    newest event that has been dropped.
+    """
+    def __init__(self, stream_id):
+        self.id = stream_id
+        self.events = deque(maxlen=MAX_STREAM_EVENTS)
+        self.base = 0
+        self.done = False
+        self.expires_at = time.time() + SEARCH_STREAM_TTL
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, payload):
+        if len(self.events) == self.events.maxlen:
+            self.base += 1
+        self.events.append(payload)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self.expires_at = time.time() + SEARCH_STREAM_TTL
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self, after=0):
+        """
+        Yield (event_id, payload) for events after `after` until the search completes
+        """
+        event_id = after
+        while True:
+            while event_id < self.base + len(self.events):
+                # Checked before every event: the buffer may move on while we are suspended
+                if event_id < self.base:
+                    # The client missed events that are no longer buffered
+                    yield self.base, {"status": "gap", "missed": self.base - event_id}
+                    event_id = self.base
+                    continue
+                event_id += 1
+                yield event_id, self.events[event_id - self.base - 1]
+            if self.done:
+                return
+            await self._changed.wait()
+
+search_streams = OrderedDict()
+
+def start_search_stream(request, query, offset=0):
+    """
+    Register a new search stream and compute it in the background
+    """
+    now = time.time()
+    for stream_id in [key for key, stream in search_streams.items() if stream.done and stream.expires_at <= now]:
+        del search_streams[stream_id]
+    while len(search_streams) >= MAX_SEARCH_STREAMS:
+        _, evicted = search_streams.popitem(last=False)
+        if not evicted.done:
+            # Nobody can attach to an evicted search, so stop spending upstream calls on it
+            evicted.publish({"status": "error", "error": "Search stream evicted"})
+            evicted.task.cancel()
+    
+    stream = SearchStream(uuid.uuid4().hex)
+    search_streams[stream.id] = stream
+    # Keep a reference so the task outlives the client connection
+    stream.task = asyncio.create_task(run_search_stream(stream, request, query, offset))
+    return stream
+
+def resume_search_stream(last_event_id):
+    """
+    Find the stream and position named by a Last-Event-ID header
+    """
+    if not last_event_id:
+        return None, 0
+    stream_id, _, event_id = last_event_id.partition(":")
+    stream = search_streams.get(stream_id)
+    if stream is None or not event_id.isdigit():
+        return None, 0
+    if stream.done and stream.expires_at <= time.time():
+        del search_streams[stream_id]
+        return None, 0
+    return stream, int(event_id)
+
+async def run_search_stream(stream, request, query, offset=0):
+    try:
+        stream.publish({"status": "started", "stream_id": stream.id})
+        
+        server = WikipediaMCPServer()
+        articles = server.iter_search_articles(query, request.limit, offset)
+        count = 0
+        while True:
+            # Score each article off the event loop and publish it as soon as it is ready
+            article = await asyncio.to_thread(next, articles, None)
+            if article is None:
+                break
+            count += 1
+            stream.publish({"status": "processing", "article": article})
+        
+        stream.publish({
+            "status": "completed",
+            "next_cursor": next_cursor(query, offset, request.limit, count)
+        })
+        
+    except Exception as e:
+        update_stats("search", request.model, error=True)
+        stream.publish({"status": "error", "error": str(e)})
+    finally:
+        stream.finish()
+
 @app.post("/search")
-async def search(request: SearchRequest):
-    update_stats("search", request.model)
+async def search(request: SearchRequest, last_event_id: Optional[str] = Header(None)):
+    stream, after = resume_search_stream(last_event_id)
+    if stream is None:
+        update_stats("search", request.model)
+        query, offset = request.topic, 0
+        try:
+            check_limit(request.limit)
+            if request.cursor:
+                query, offset = decode_cursor(request.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        stream = start_search_stream(request, query, offset)
     
     async def generate():
-        try:
-            server = WikipediaMCPServer()
-            articles = await server.search_articles(request.topic, request.limit)
-            
-            # Send initial status
-            yield f"data: {json.dumps({'status': 'started'})}\n\n"
-            
-            # Send articles as they are found
-            for article in articles:
-                yield f"data: {json.dumps({'status': 'processing', 'article': article})}\n\n"
-                await asyncio.sleep(0.1)  # Small delay between articles
-            
-            # Send completion status
-            yield f"data: {json.dumps({'status': 'completed'})}\n\n"
-            
-        except Exception as e:
-            update_stats("search", request.model, error=True)
-            yield f"data: {json.dumps({'status': 'error', 'error': str(e)})}\n\n"
+        async for event_id, payload in stream.follow(after):
+            yield f"id: {stream.id}:{event_id}\ndata: {json.dumps(payload)}\n\n"
     
     return StreamingResponse(
         generate(),
@@ -491,10 +1074,14 @@ async def evaluate(request: EvaluateRequest):
             "Content-Type": "application/json"
         }
         
-        prompt = f"Evaluate the relevance of this article to the topic: {request.article.title}\n\n{request.article.snippet}"
         data = {
             "model": request.model,
-            "messages": [{"role": "user", "content": prompt}]
+            "messages": build_messages(
+                request.model,
+                "Evaluate the relevance of this article to the topic: {title}",
+                request.article.snippet,
+                fields={"title": request.article.title}
+            )
         }
         
         response = requests.post(
@@ -506,8 +1093,10 @@ async def evaluate(request: EvaluateRequest):
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail="Failed to evaluate article")
         
+        result = response.json()
+        record_tokens("evaluate", request.model, result.get("usage"))
         return {
-            "relevance": response.json()["choices"][0]["message"]["content"],
+            "relevance": result["choices"][0]["message"]["content"],
             "article": request.article
         }
         
@@ -525,10 +1114,14 @@ async def analyze(request: AnalyzeRequest):
             "Content-Type": "application/json"
         }
         
-        prompt = f"Analyze this article and provide key insights: {request.article.title}\n\n{request.article.snippet}"
         data = {
             "model": request.model,
-            "messages": [{"role": "user", "content": prompt}]
+            "messages": build_messages(
+                request.model,
+                "Analyze this article and provide key insights: {title}",
+                request.article.snippet,
+                fields={"title": request.article.title}
+            )
         }
         
         response = requests.post(
@@ -540,8 +1133,10 @@ async def analyze(request: AnalyzeRequest):
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail="Failed to analyze article")
         
+        result = response.json()
+        record_tokens("analyze", request.model, result.get("usage"))
         return {
-            "analysis": response.json()["choices"][0]["message"]["content"],
+            "analysis": result["choices"][0]["message"]["content"],
             "article": request.article
         }
         
@@ -551,36 +1146,170 @@ async def analyze(request: AnalyzeRequest):
 
 @app.get("/stats")
 async def stats():
-    return load_stats()
+    current = load_stats()
+    # Include usage that has not been written to the stats file yet
+    merge_tokens(current, take_pending_tokens(clear=False))
+    current["popular_queries"] = query_popularity.top(PREFETCH_TOP_N)
+    current["popular_titles"] = title_popularity.top(PREFETCH_TOP_N)
+    current["cache"] = {
+        "searches": len(search_cache),
+        "articles": len(article_cache),
+        "search_hit_ratio": search_cache.hit_ratio(),
+        "article_hit_ratio": article_cache.hit_ratio()
+    }
+    return current
+
+async def prefetch_popular():
+    """
+    Prefetch and pre-score the most popular queries and articles before they expire
+    """
+    server = WikipediaMCPServer()
+    titles = [
+        title for title, _ in title_popularity.top(PREFETCH_TOP_N)
+        if article_cache.needs_refresh(title, PREFETCH_REFRESH_WINDOW)
+    ]
+    # Searches are expensive; keep enough budget for the titles (up to half of it)
+    title_reserve = min(len(titles), prefetch_budget.limit // 2)
+    
+    for query, _ in query_popularity.top(PREFETCH_TOP_N):
+        if not search_cache.needs_refresh(query, PREFETCH_REFRESH_WINDOW):
+            continue
+        # Popularity is keyed by canonical form; the entry remembers the phrase to search
+        entry = search_cache.peek(query)
+        if entry is None:
+            continue
+        # Refresh with the size clients asked for so live lookups still hit
+        limit = entry["limit"]
+        # One Wikipedia search plus one relevance call per article; skip what we can't afford
+        if not prefetch_budget.try_spend(1 + limit, reserve=title_reserve):
+            continue
+        articles = await asyncio.to_thread(
+            server.fetch_search_articles, entry["query"], limit, endpoint="prefetch"
+        )
+        search_cache.set(query, {"query": entry["query"], "limit": limit, "articles": articles})
+    
+    for title in titles:
+        if not prefetch_budget.try_spend(1):
+            break
+        article = await asyncio.to_thread(server.fetch_article, title)
+        if "error" not in article:
+            article_cache.set(title, article)
+
+async def prefetch_loop():
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        try:
+            await prefetch_popular()
+        except Exception as e:
+            print(f"Error prefetching popular items: {str(e)}")
+        query_popularity.decay()
+        title_popularity.decay()
+
+@app.on_event("startup")
+async def start_prefetch():
+    if PREFETCH_ENABLED:
+        app.state.prefetch_task = asyncio.create_task(prefetch_loop())
+
+# MCP sessions
+class MCPSession:
+    """
+    MCP session bound to one /sse connection; kept small so idle sessions are cheap
+    """
+    __slots__ = ("id", "queue", "inflight", "tasks")
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.queue = asyncio.Queue(maxsize=SESSION_QUEUE_SIZE)
+        self.inflight = 0
+        self.tasks = None
+
+    def submit(self, request_id, data):
+        """
+        Start a tool call; returns False if the session has too many calls in flight
+        """
+        if self.inflight >= SESSION_MAX_INFLIGHT:
+            return False
+        self.inflight += 1
+        if self.tasks is None:
+            self.tasks = set()
+        task = asyncio.create_task(self._run(request_id, data))
+        self.tasks.add(task)
+        task.add_done_callback(self._finished)
+        return True
+
+    async def _run(self, request_id, data):
+        response = await asyncio.to_thread(mcp_server.handle_request, data)
+        # Blocks while the client is not draining its stream (backpressure)
+        await self.queue.put({"type": "result", "id": request_id, "result": response})
+
+    def _finished(self, task):
+        self.inflight -= 1
+        self.tasks.discard(task)
+        if not self.tasks:
+            self.tasks = None
+
+    def close(self):
+        if self.tasks:
+            for task in list(self.tasks):
+                task.cancel()
+
+mcp_server = WikipediaMCPServer()
+sessions = {}
+
+def open_session():
+    session = MCPSession(uuid.uuid4().hex)
+    sessions[session.id] = session
+    return session
+
+async def session_events():
+    """
+    Open a session and stream its init event, tool results and keep-alive pings
+    """
+    # Registered only once the response starts, so the finally below always cleans up
+    session = open_session()
+    try:
+        tools = mcp_server.get_tools()
+        resources = mcp_server.get_resources()
+        
+        yield "data: " + json.dumps({
+            "type": "init",
+            "session_id": session.id,
+            "endpoint": f"/mcp?session_id={session.id}",
+            "tools": tools["tools"],
+            "resources": resources["resources"]
+        }) + "\n\n"
+        
+        while True:
+            event = await session.queue.get()
+            yield "data: " + json.dumps(event) + "\n\n"
+            
+    except Exception as e:
+        yield "data: " + json.dumps({"type": "error", "message": str(e)}) + "\n\n"
+    finally:
+        sessions.pop(session.id, None)
+        session.close()
+
+async def keepalive_loop():
+    """
+    Ping idle sessions from a single timer instead of one timer per connection
+    """
+    while True:
+        await asyncio.sleep(KEEPALIVE_TIMEOUT / 2)
+        for session in list(sessions.values()):
+            if session.queue.empty():
+                session.queue.put_nowait({"type": "ping"})
+
+@app.on_event("startup")
+async def start_keepalive():
+    app.state.keepalive_task = asyncio.create_task(keepalive_loop())
 
 @app.get("/sse")
 async def sse_endpoint(request: Request):
     """
     SSE endpoint for MCP protocol
     """
-    async def generate():
-        try:
-            # Send initial response with tools and resources
-            server = WikipediaMCPServer()
-            tools = server.get_tools()
-            resources = server.get_resources()
-            
-            yield "data: " + json.dumps({
-                "type": "init",
-                "tools": tools["tools"],
-                "resources": resources["resources"]
-            }) + "\n\n"
-            
-            # Keep connection alive
-            while True:
-                await asyncio.sleep(KEEPALIVE_TIMEOUT / 2)
-                yield "data: " + json.dumps({"type": "ping"}) + "\n\n"
-                
-        except Exception as e:
-            yield "data: " + json.dumps({"type": "error", "message": str(e)}) + "\n\n"
-    
     return StreamingResponse(
-        generate(),
+        session_events(),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -590,14 +1319,35 @@ async def sse_endpoint(request: Request):
     )
 
 @app.post("/mcp")
-async def mcp_endpoint(request: Request):
+async def mcp_endpoint(request: Request, session_id: Optional[str] = None):
     """
     Main MCP endpoint for handling tool calls
+    
+    With a session_id the call runs in the background and its result is
+    streamed over that session's /sse connection.
     """
     try:
         data = await request.json()
-        server = WikipediaMCPServer()
-        response = server.handle_request(data)
+        
+        if session_id is not None:
+            session = sessions.get(session_id)
+            if session is None:
+                return JSONResponse(
+                    status_code=404,
+                    content={"error": f"Unknown session: {session_id}"}
+                )
+            request_id = data.get("id") or uuid.uuid4().hex
+            if not session.submit(request_id, data):
+                return JSONResponse(
+                    status_code=429,
+                    content={"error": "Too many calls in flight for session"}
+                )
+            return JSONResponse(
+                status_code=202,
+                content={"id": request_id, "status": "accepted"}
+            )
+        
+        response = await asyncio.to_thread(mcp_server.handle_request, data)
         return JSONResponse(content=response)
     except Exception as e:
         return JSONResponse(
@@ -605,6 +1355,238 @@ async def mcp_endpoint(request: Request):
             content={"error": str(e)}
         )
 
+# Diagnostics
+def require_admin(authorization: Optional[str] = Header(None)):
+    """
+    Admin endpoints are hidden unless ADMIN_TOKEN is set and require it as a bearer token
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Compare bytes: compare_digest rejects non-ASCII str with a TypeError
+    expected = f"Bearer {ADMIN_TOKEN}".encode("utf-8")
+    if not authorization or not hmac.compare_digest(authorization.encode("utf-8"), expected):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+def frame_label(code):
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+# Leaf frames of threads that are parked rather than running:
+# the event loop in select, executor workers waiting for work, and lock/queue waits
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("threading.py", "wait"),
+    ("queue.py", "get")
+}
+
+def is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+def sample_profile(seconds, top=20):
+    """
+    Sample the stacks of every busy thread for `seconds` and rank functions by samples
+    """
+    skipped_threads = {threading.get_ident(), loop_monitor.watch_thread}
+    self_counts = {}
+    total_counts = {}
+    samples = 0
+    idle_samples = 0
+    deadline = time.monotonic() + seconds
+    
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in skipped_threads:
+                continue
+            if is_idle(frame):
+                idle_samples += 1
+                continue
+            samples += 1
+            leaf = frame_label(frame.f_code)
+            self_counts[leaf] = self_counts.get(leaf, 0) + 1
+            # Count recursive functions once per sample
+            seen = set()
+            while frame is not None:
+                label = frame_label(frame.f_code)
+                if label not in seen:
+                    seen.add(label)
+                    total_counts[label] = total_counts.get(label, 0) + 1
+                frame = frame.f_back
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+    
+    def ranked(counts):
+        items = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:top]
+        return [
+            {"function": label, "samples": count, "percent": round(100 * count / samples, 2)}
+            for label, count in items
+        ]
+    
+    return {
+        "seconds": seconds,
+        "samples": samples,
+        "idle_samples": idle_samples,
+        "self": ranked(self_counts),
+        "total": ranked(total_counts)
+    }
+
+# Types whose live instances are counted in memory reports
+TRACKED_TYPES = (
+    "WikipediaMCPServer", "MCPSession", "SearchStream",
+    "generator", "async_generator", "coroutine", "Task"
+)
+memory_baseline = None
+
+def count_objects():
+    counts = dict.fromkeys(TRACKED_TYPES, 0)
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name in counts:
+            counts[name] += 1
+    counts["sessions"] = len(sessions)
+    counts["search_streams"] = len(search_streams)
+    return counts
+
+def take_snapshot():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(10)
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ))
+
+class LoopMonitor:
+    """
+    Measures event-loop lag and captures the loop's stack while it is blocked
+    """
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+        self.heartbeat = time.monotonic()
+        self.blocked = deque(maxlen=20)
+        self.loop_thread = None
+        self.watch_thread = None
+
+    async def run(self):
+        self.loop_thread = threading.get_ident()
+        # Startup time is not a stall
+        self.heartbeat = time.monotonic()
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+        self.watch_thread = watcher.ident
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            self.lag = max(self.heartbeat - start - self.interval, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.total_lag += self.lag
+            self.samples += 1
+
+    def watch(self):
+        """
+        Runs in its own thread so it can see the loop while a handler blocks it
+        """
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < self.interval + self.threshold or reported == heartbeat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            reported = heartbeat
+            self.blocked.append({
+                "time": time.time(),
+                "blocked_ms": round(stalled * 1000, 1),
+                "stack": traceback.format_stack(frame)[-10:]
+            })
+
+    def report(self):
+        return {
+            "lag_ms": round(self.lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "mean_lag_ms": round(self.total_lag * 1000 / self.samples, 2) if self.samples else 0.0,
+            "samples": self.samples,
+            "blocked": list(self.blocked)
+        }
+
+loop_monitor = LoopMonitor()
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    if ADMIN_TOKEN:
+        app.state.loop_monitor_task = asyncio.create_task(loop_monitor.run())
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def admin_profile(seconds: float = 5, top: int = 20):
+    """
+    Time-boxed sampling CPU profile of all threads in this worker
+    """
+    seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+    return await asyncio.to_thread(sample_profile, seconds, top)
+
+def memory_snapshot_report(top):
+    global memory_baseline
+    memory_baseline = take_snapshot()
+    return {
+        "traced_bytes": tracemalloc.get_traced_memory()[0],
+        "top": [str(stat) for stat in memory_baseline.statistics("lineno")[:top]],
+        "objects": count_objects()
+    }
+
+def memory_diff_report(baseline, top):
+    snapshot = take_snapshot()
+    return {
+        "traced_bytes": tracemalloc.get_traced_memory()[0],
+        "diff": [
+            {
+                "location": str(stat.traceback[0]),
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+                "size": stat.size
+            }
+            for stat in snapshot.compare_to(baseline, "lineno")[:top]
+        ],
+        "objects": count_objects()
+    }
+
+@app.post("/admin/memory/snapshot", dependencies=[Depends(require_admin)])
+async def admin_memory_snapshot(top: int = 20):
+    """
+    Start tracing allocations if needed and store a baseline snapshot
+    """
+    # Snapshots and gc scans are slow; keep them off the event loop
+    return await asyncio.to_thread(memory_snapshot_report, top)
+
+@app.get("/admin/memory/diff", dependencies=[Depends(require_admin)])
+async def admin_memory_diff(top: int = 20):
+    """
+    Allocation growth since the baseline snapshot
+    """
+    baseline = memory_baseline
+    if baseline is None:
+        raise HTTPException(status_code=400, detail="No baseline snapshot, POST /admin/memory/snapshot first")
+    return await asyncio.to_thread(memory_diff_report, baseline, top)
+
+@app.delete("/admin/memory", dependencies=[Depends(require_admin)])
+async def admin_memory_stop():
+    """
+    Stop allocation tracing and drop the baseline
+    """
+    global memory_baseline
+    memory_baseline = None
+    tracemalloc.stop()
+    return {"tracing": False}
+
+@app.get("/admin/loop", dependencies=[Depends(require_admin)])
+async def admin_loop():
+    return loop_monitor.report()
+
 def main():
     """
     Main function to run the MCP server